@@ -9,37 +9,248 @@ It is filled out based on the work of the ETL Jupyter notebook.
 # Imports
 ##############################
 import os
-import glob
+import io
+import csv
 import psycopg2
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from psycopg2.extras import execute_values
 from sql_queries import *
 
 
-def process_song_file(cur, filepath):
+# number of rows sent with one multi-row INSERT statement
+PAGE_SIZE = 1000
+
+# number of parsed song rows collected before they are bulk loaded
+FLUSH_ROWS = 5000
+
+# number of song files handed over to a parser process at once
+PARSE_CHUNKSIZE = 64
+
+# song files are parsed by a process pool of at most PARSE_WORKERS processes
+# only from PARALLEL_MIN_FILES files on, below the pool start-up costs more than it saves
+PARSE_WORKERS = 4
+PARALLEL_MIN_FILES = 1000
+
+# low-cardinality log columns, which are used afterwards, stored as categories instead of python string objects
+CATEGORY_COLUMNS = ('level', 'gender', 'page')
+
+# JSON lines parser of pandas (>= 2.0), the pyarrow engine uses Arrow's C++ reader
+JSON_ENGINE = 'pyarrow'
+
+# numeric columns, which are null in whole song files and are read by pyarrow as object columns of None
+FLOAT_COLUMNS = ('artist_latitude', 'artist_longitude')
+
+
+def insert_song_rows(cur, df):
     """
-    Processes a song file from the song_data directory and
-    store its record data in the song and artists tables.
+    Inserts the song and artist records of a song dataframe row by row,
+    used to retry a song chunk whose COPY failed, see copy_song_frames().
+    The statements of `prepare_queries` must have been prepared on the session, see main().
     
     Input:
         cur (cursor): cursor of Postgres Db connection
-        filepath (string): filepath of song_data dir about songs and artists
+        df (DataFrame): records of song files
+    Output:
+        None
+    """
+    for row in df[['song_id', 'title', 'artist_id', 'year', 'duration']].itertuples(index=False, name=None):
+        cur.execute(song_table_execute, row)
+
+    for row in df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].itertuples(index=False, name=None):
+        cur.execute(artist_table_execute, row)
+
+
+def copy_dataframe(cur, df, copy_query):
+    """
+    Bulk loads the rows of a dataframe as CSV with COPY, e.g. into a staging table.
+    Missing values are written as \\N, so that empty strings are not loaded as NULL.
+    
+    Input:
+        cur (cursor): cursor of Postgres Db connection
+        df (DataFrame): records, the column order must match the column list of the COPY query
+        copy_query (string): COPY ... FROM STDIN WITH (FORMAT csv, NULL '\\N') statement
+    Output:
+        None
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep='\\N')
+    buf.seek(0)
+    cur.copy_expert(copy_query, buf)
+
+
+def copy_rows(cur, rows, copy_query):
+    """
+    Bulk loads a list of record tuples as CSV with COPY.
+    Missing values (None, NaN) are written as \\N, so that empty strings are not loaded as NULL.
+    
+    Input:
+        cur (cursor): cursor of Postgres Db connection
+        rows (list): record tuples, the value order must match the column list of the COPY query
+        copy_query (string): COPY ... FROM STDIN WITH (FORMAT csv, NULL '\\N') statement
+    Output:
+        None
+    """
+    buf = io.StringIO()
+    csv.writer(buf).writerows(['\\N' if pd.isna(value) else value for value in row] for row in rows)
+    buf.seek(0)
+    cur.copy_expert(copy_query, buf)
+
+
+def read_json_file(filepath):
+    """
+    Reads a JSON lines file into a dataframe with the JSON_ENGINE parser,
+    used by the parser processes as well.
+    
+    Input:
+        filepath (string): filepath of a data file
+    Output:
+        df (DataFrame): records of the file
+    """
+    df = pd.read_json(filepath, lines=True, engine=JSON_ENGINE)
+
+    # keep the frames numeric, so that their concatenation doesn't deal with all-NA object columns
+    return df.astype({column: float for column in FLOAT_COLUMNS if column in df})
+
+
+def parse_json_files(all_files):
+    """
+    Parses the given JSON lines files, serially for less than PARALLEL_MIN_FILES files,
+    otherwise by a process pool of at most PARSE_WORKERS processes.
+    Each pool process imports pandas and pyarrow on its own, and executor.map() submits
+    all files up front, so the pool only pays off for a large number of files.
+    
+    Input:
+        all_files (list): filepaths of the data files
+    Output:
+        yields the dataframes of the files in the order of all_files
+    """
+    if len(all_files) < PARALLEL_MIN_FILES:
+        yield from map(read_json_file, all_files)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, os.cpu_count() or 1)) as executor:
+        yield from executor.map(read_json_file, all_files, chunksize=PARSE_CHUNKSIZE)
+
+
+def copy_song_frames(cur, conn, frames):
+    """
+    Bulk loads parsed song files with COPY into the unlogged staging tables,
+    the chunk is committed in one transaction, which is rolled back on a db error.
+    In that case, the records are inserted directly with row inserts.
+    
+    Input:
+        cur (cursor): cursor of Postgres Db connection
+        conn (object): Postgres Db connection object
+        frames (list): dataframes of parsed song files
+    Output:
+        None
+    """
+    df = pd.concat(frames, ignore_index=True)
+
+    try:
+        # copy song records
+        songs_df = df[['song_id', 'title', 'artist_id', 'year', 'duration']]
+        copy_dataframe(cur, songs_df, song_staging_copy)
+
+        # copy artist records
+        artists_df = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']]
+        copy_dataframe(cur, artists_df, artist_staging_copy)
+
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        print("Error: Copying song rows, falling back to row inserts")
+        print(e)
+
+        # insert file by file, so that only the faulty files are skipped
+        for frame in frames:
+            try:
+                insert_song_rows(cur, frame)
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                print("Error: Inserting song rows")
+                print(e)
+
+
+def run_queries(cur, conn, queries):
+    """
+    Executes the given queries in one transaction.
+    On a db error the transaction is rolled back, the failing statement is printed
+    and the error is raised again, because the load can't continue without these steps.
+    
+    Input:
+        cur (cursor): cursor of Postgres Db connection
+        conn (object): Postgres Db connection object
+        queries (list): sql statements
     Output:
         None
     """
+    for query in queries:
+        try:
+            cur.execute(query)
+        except psycopg2.Error:
+            conn.rollback()
+            print(f"Error: Running query {' '.join(query.split())}")
+            raise
+    conn.commit()
+
+
+def process_song_files(cur, conn, filepath):
+    """
+    Processes all song files from the song_data directory:
+    the files are parsed by parse_json_files(), in parallel for large directories only, while the parsed records
+    are copied in chunks of FLUSH_ROWS rows by the single db connection of the main process
+    into the unlogged staging tables. Afterwards, they are merged once into the songs and artists tables
+    with their conflict handling.
     
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    Input:
+        cur (cursor): cursor of Postgres Db connection
+        conn (object): Postgres Db connection object
+        filepath (string): filepath of song_data dir about songs and artists
+    Output:
+        Prints out the total number of files found together with the iteration status number, see iter_files().
+    """
+    frames = []
+    num_rows = 0
+
+    # remove leftovers of an aborted run
+    run_queries(cur, conn, staging_truncate_queries)
+
+    for df in iter_files(filepath, parse=parse_json_files):
+        frames.append(df)
+        num_rows += len(df)
 
-    # insert song record
-    song_data = list(df[['song_id', 'title', 'artist_id', 'year', 'duration']].values[0])
-    cur.execute(song_table_insert, song_data)
+        if num_rows >= FLUSH_ROWS:
+            copy_song_frames(cur, conn, frames)
+            frames = []
+            num_rows = 0
+
+    # copy the remaining records
+    if frames:
+        copy_song_frames(cur, conn, frames)
+
+    # merge the staging tables into the final tables and empty them
+    run_queries(cur, conn, staging_merge_queries + staging_truncate_queries)
+
+
+def load_song_lookup(cur):
+    """
+    Loads the join of the songs and artists tables once into memory,
+    so that the songplays records are resolved without a query per log row.
     
-    # insert artist record
-    artist_data = list(df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values[0])
-    cur.execute(artist_table_insert, artist_data)
+    Input:
+        cur (cursor): cursor of Postgres DB connection
+    Output:
+        song_lookup (dict): maps (title, artist name, duration) to (song_id, artist_id)
+    """
+    cur.execute(song_lookup_select)
+    return {(title, name, duration): (song_id, artist_id)
+            for title, name, duration, song_id, artist_id in cur.fetchall()}
 
 
-def process_log_file(cur, filepath):
+def process_log_file(cur, filepath, song_lookup):
     """
     Processes a log file from the log_data directory and
     store its record data in the time and users dimensional tables.
@@ -48,97 +259,157 @@ def process_log_file(cur, filepath):
     Input:
         cur (cursor): cursor of Postgres DB connection
         filepath (string): filepath of log_data dir about time and users
+        song_lookup (dict): (title, artist name, duration) to (song_id, artist_id), see load_song_lookup()
     Output:
         None
     """
 
     # open log file
-    df = pd.read_json(filepath, lines=True)
+    df = read_json_file(filepath)
+
+    # the NextSong filter on page compares category codes, the inserted values stay strings
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
 
     # filter by NextSong action
     df = df[df['page'] == 'NextSong']
 
-    # convert timestamp column to datetime
+    # convert timestamp column to datetime, kept as start_time column for the songplays records
     t = pd.to_datetime(df['ts'], unit='ms')
+    df = df.assign(start_time=t)
     
     # insert time data records
     # the songplays table includes the timestamp in its start_time column
-    time_data = ([item, item.hour, item.day, item.week, item.month, item.year, item.dayofweek] for item in t)
-    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame(data=time_data, columns=column_labels)
+    # the units are extracted column-wise by the .dt accessors, isocalendar() returns a nullable UInt32 week
+    time_df = pd.DataFrame({'start_time': t,
+                            'hour': t.dt.hour,
+                            'day': t.dt.day,
+                            'week': t.dt.isocalendar().week.astype(int),
+                            'month': t.dt.month,
+                            'year': t.dt.year,
+                            'weekday': t.dt.dayofweek})
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    execute_values(cur, time_table_batch_insert, list(time_df.itertuples(index=False, name=None)), page_size=PAGE_SIZE)
 
     # load user table
     # note: duplicates exists in the original dataframe, we remove them having only one row for each user
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']].drop_duplicates()
+    # with its latest level, a multi-row INSERT ... ON CONFLICT DO UPDATE must not touch the same user_id twice
+    user_df = df.sort_values('ts').drop_duplicates('userId', keep='last')[['userId', 'firstName', 'lastName', 'gender', 'level']]
 
     # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    execute_values(cur, user_table_batch_insert, list(user_df.itertuples(index=False, name=None)), page_size=PAGE_SIZE)
+
+    # insert songplay records, built in one pass and sent as one COPY batch
+    # fetch the block of songplay ids from the sequence with one query
+    cur.execute(songplay_id_select, (len(df),))
+    songplay_ids = [songplay_id for songplay_id, in cur.fetchall()]
 
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
+    # get songid and artistid of the preloaded song and artist tables
+    songplay_columns = ['start_time', 'userId', 'level', 'song', 'artist', 'length', 'sessionId', 'location', 'userAgent']
+    songplay_data = [
+        (songplay_id, start_time, user_id, level, *song_lookup.get((song, artist, length), (None, None)),
+         session_id, location, user_agent)
+        for songplay_id, (start_time, user_id, level, song, artist, length, session_id, location, user_agent) in
+        zip(songplay_ids, df[songplay_columns].itertuples(index=False, name=None))
+    ]
 
-        # insert songplay record
-        songplay_data = (pd.to_datetime(row.ts, unit='ms'), row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+    copy_rows(cur, songplay_data, songplay_copy)
 
 
-def process_data(cur, conn, filepath, func):
+def iter_json(filepath):
     """
-    Iterator function to process all data for Postgres database storage.
+    Yields all JSON files of a data directory lazily,
+    walking the directory tree once with os.scandir.
     
     Input:
-        cur (cursor): cursor of Postgres Db connection
-        conn (object): Postgres Db connection object
         filepath (string): filepath to the data directories (song_data, log_data)
-        func: function to be executed (process_song_file, process_log_file)
     Output:
-        Prints out the total number of files found together with the iteration status number.
+        yields the absolute filepaths of the JSON files
     """
+    for entry in os.scandir(filepath):
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_json(entry.path)
+        elif entry.name.endswith('.json'):
+            yield os.path.abspath(entry.path)
+
+
+def iter_files(filepath, parse=None):
+    """
+    Lists all JSON files of a data directory and yields them one by one,
+    used by both the song_data and the log_data phase.
     
+    Input:
+        filepath (string): filepath to the data directories (song_data, log_data)
+        parse: optional function turning the list of files into an iterable of parsed files (e.g. parse_json_files)
+    Output:
+        yields the filepaths, or the parsed files if parse is given.
+        Prints out the total number of files found together with the iteration status number about every percent.
+    """
+
     # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    all_files = list(iter_json(filepath))
 
     # get total number of files found
     num_files = len(all_files)
-    print('{num_files} files found in {filepath}')
+    print(f'{num_files} files found in {filepath}')
+
+    # report the progress about every percent instead of after each file
+    report_every = max(1, num_files // 100)
+
+    items = all_files if parse is None else parse(all_files)
+    for i, item in enumerate(items, 1):
+        yield item
+        if i % report_every == 0 or i == num_files:
+            print(f'{i}/{num_files} files processed.')
+
 
+def process_data(cur, conn, filepath, func, **kwargs):
+    """
+    Iterator function to process all data for Postgres database storage.
+    
+    Input:
+        cur (cursor): cursor of Postgres Db connection
+        conn (object): Postgres Db connection object
+        filepath (string): filepath to the data directories (song_data, log_data)
+        func: function to be executed per file (e.g. process_log_file)
+        kwargs: additional keyword arguments handed over to func (e.g. song_lookup)
+    Output:
+        Prints out the total number of files found together with the iteration status number, see iter_files().
+        Each file is processed in its own transaction, which is rolled back on a db error.
+    """
+    
     # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        print(f'{i}/{num_files} files processed.')
+    for datafile in iter_files(filepath):
+        try:
+            func(cur, datafile, **kwargs)
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f'Error: Processing {datafile}')
+            print(e)
 
 
 def main():
     """
     Main ETL workflow setting for Postgres Db connection and cursor.
-    Auto commit is configured to be True.
+    Auto commit is turned off, the data is committed once per loaded batch.
+    The session is tuned for the bulk load, e.g. by asynchronous commits,
+    these settings are session-scoped and don't affect other clients.
+    The row insert statements of the fallback path are prepared once for the session,
+    separately from the settings; a failure of either setup step stops the run.
     Furthermore, triggers the processing of the files included in the directories song_data and log_data.
-    Finally, the Db connection is closed.
+    Finally, the prepared statements are dropped and the Db connection is closed.
     """
     conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
     cur = conn.cursor()
-    conn.set_session(autocommit=True)
+    run_queries(cur, conn, session_setting_queries)
+    run_queries(cur, conn, prepare_queries)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    process_song_files(cur, conn, filepath='data/song_data')
+    song_lookup = load_song_lookup(cur)
+    process_data(cur, conn, filepath='data/log_data', func=process_log_file, song_lookup=song_lookup)
 
+    run_queries(cur, conn, deallocate_queries)
     conn.close()
 
 
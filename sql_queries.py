@@ -31,6 +31,15 @@ https://www.prisma.io/dataguide/postgresql/inserting-and-modifying-data/insert-o
 # Coding
 ##############################
 
+#
+# SESSION SETTINGS
+# bulk load tuning of the ETL connection, session-scoped, other clients are not affected
+#
+synchronous_commit_off = "SET synchronous_commit TO off"
+work_mem_set = "SET work_mem TO '64MB'"
+maintenance_work_mem_set = "SET maintenance_work_mem TO '256MB'"
+check_function_bodies_off = "SET check_function_bodies TO off"
+
 #
 # DROP TABLES
 #
@@ -39,173 +48,242 @@ user_table_drop = "DROP table IF EXISTS users"
 song_table_drop = "DROP table IF EXISTS songs"
 artist_table_drop = "DROP table IF EXISTS artists"
 time_table_drop = "DROP table IF EXISTS time"
+song_staging_table_drop = "DROP table IF EXISTS songs_staging"
+artist_staging_table_drop = "DROP table IF EXISTS artists_staging"
 
 #
 # CREATE TABLES
 # add NOT NULL info for relevant attributes
 #
-try:
-    songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays ( \
-                                    songplay_id SERIAL PRIMARY KEY, \
-                                    start_time timestamp NOT NULL, \
-                                    user_id int NOT NULL, \
-                                    level varchar, \
-                                    song_id varchar, \
-                                    artist_id varchar, \
-                                    session_id int, \
-                                    location varchar, \
-                                    user_agent varchar \
-                             );""")
-except psycopg2.Error as e: 
-    print("Error: Issue creating songplay table")
-    print (e)
-
-try:
-    user_table_create = ("""CREATE TABLE IF NOT EXISTS users( \
-                                    user_id int PRIMARY KEY NOT NULL, \
-                                    first_name varchar, \
-                                    last_name varchar, \
-                                    gender varchar, \
-                                    level varchar \
+songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays ( \
+                                songplay_id SERIAL PRIMARY KEY, \
+                                start_time timestamp NOT NULL, \
+                                user_id int NOT NULL, \
+                                level varchar, \
+                                song_id varchar, \
+                                artist_id varchar, \
+                                session_id int, \
+                                location varchar, \
+                                user_agent varchar \
                          );""")
-except psycopg2.Error as e: 
-    print("Error: Issue creating user table")
-    print (e)
-
-try:
-    song_table_create = ("""CREATE TABLE IF NOT EXISTS songs( \
-                                    song_id varchar PRIMARY KEY, \
-                                    title varchar NOT NULL, \
-                                    artist_id varchar, \
-                                    year int, \
-                                    duration float NOT NULL\
-                         );""")
-except psycopg2.Error as e: 
-    print("Error: Issue creating song table")
-    print (e)
-
-try:
-    artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists ( \
-                                    artist_id varchar PRIMARY KEY, \
-                                    name varchar NOT NULL, \
-                                    location varchar, \
-                                    latitude float, \
-                                    longitude float \
-                           );""")
-except psycopg2.Error as e: 
-    print("Error: Issue creating artist table")
-    print (e)
-
-try:
-    time_table_create = ("""CREATE TABLE IF NOT EXISTS time ( \
-                                    start_time timestamp NOT NULL, \
-                                    hour int, \
-                                    day int, \
-                                    week int, \
-                                    month int, \
-                                    year int, \
-                                    weekday int \
-                         );""")
-except psycopg2.Error as e: 
-    print("Error: Issue creating time table")
-    print (e)
+
+user_table_create = ("""CREATE TABLE IF NOT EXISTS users( \
+                                user_id int PRIMARY KEY NOT NULL, \
+                                first_name varchar, \
+                                last_name varchar, \
+                                gender varchar, \
+                                level varchar \
+                     );""")
+
+song_table_create = ("""CREATE TABLE IF NOT EXISTS songs( \
+                                song_id varchar PRIMARY KEY, \
+                                title varchar NOT NULL, \
+                                artist_id varchar, \
+                                year int, \
+                                duration float NOT NULL\
+                     );""")
+
+artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists ( \
+                                artist_id varchar PRIMARY KEY, \
+                                name varchar NOT NULL, \
+                                location varchar, \
+                                latitude float, \
+                                longitude float \
+                       );""")
+
+time_table_create = ("""CREATE TABLE IF NOT EXISTS time ( \
+                                start_time timestamp NOT NULL, \
+                                hour int, \
+                                day int, \
+                                week int, \
+                                month int, \
+                                year int, \
+                                weekday int \
+                     );""")
+
+#
+# CREATE STAGING TABLES
+# unlogged and without primary keys (LIKE copies the NOT NULL constraints only),
+# bulk loaded via COPY before merging into the final tables
+#
+song_staging_table_create = ("""CREATE UNLOGGED TABLE IF NOT EXISTS songs_staging \
+                                (LIKE songs INCLUDING DEFAULTS);""")
+
+artist_staging_table_create = ("""CREATE UNLOGGED TABLE IF NOT EXISTS artists_staging \
+                                  (LIKE artists INCLUDING DEFAULTS);""")
 
 # 
 # INSERT RECORDS
 # take care of conflicts during insertion of rows
 #
-try:
-    songplay_table_insert = ("""INSERT INTO songplays ( \
-                                    start_time,  \
-                                    user_id,  \
-                                    level,  \
-                                    song_id,  \
-                                    artist_id,  \
-                                    session_id,  \
-                                    location,  \
-                                    user_agent) \
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s) \
-                                ON CONFLICT DO NOTHING; \
-                             """)
-except psycopg2.Error as e: 
-    print("Error: Inserting songplay rows")
-    print (e)
-
-try:
-    user_table_insert = ("""INSERT INTO users ( \
+songplay_table_insert = ("""INSERT INTO songplays ( \
+                                start_time,  \
                                 user_id,  \
-                                first_name,  \
-                                last_name,  \
-                                gender,  \
-                                level) \
-                            VALUES (%s, %s, %s, %s, %s) \
-                            ON CONFLICT (user_id) DO UPDATE \
-                            SET level = EXCLUDED.level; \
-                         """)
-except psycopg2.Error as e: 
-    print("Error: Inserting user rows")
-    print (e)
-
-try:
-    song_table_insert = ("""INSERT INTO songs ( \
+                                level,  \
                                 song_id,  \
-                                title,  \
                                 artist_id,  \
-                                year, \
-                                duration) \
-                            VALUES (%s, %s, %s, %s, %s) \
-                            ON CONFLICT (song_id) DO NOTHING; \
+                                session_id,  \
+                                location,  \
+                                user_agent) \
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) \
+                            ON CONFLICT DO NOTHING; \
                          """)
-except psycopg2.Error as e: 
-    print("Error: Inserting song rows")
-    print (e)
 
-try:
-    artist_table_insert = ("""INSERT INTO artists ( \
-                                artist_id,  \
-                                name,  \
-                                location,  \
-                                latitude,  \
-                                longitude) \
-                              VALUES (%s, %s, %s, %s, %s) \
-                              ON CONFLICT (artist_id) DO UPDATE \
-                              SET name = EXCLUDED.name
-                              ; \
+user_table_insert = ("""INSERT INTO users ( \
+                            user_id,  \
+                            first_name,  \
+                            last_name,  \
+                            gender,  \
+                            level) \
+                        VALUES (%s, %s, %s, %s, %s) \
+                        ON CONFLICT (user_id) DO UPDATE \
+                        SET level = EXCLUDED.level; \
+                     """)
+
+song_table_insert = ("""INSERT INTO songs ( \
+                            song_id,  \
+                            title,  \
+                            artist_id,  \
+                            year, \
+                            duration) \
+                        VALUES (%s, %s, %s, %s, %s) \
+                        ON CONFLICT (song_id) DO NOTHING; \
+                     """)
+
+artist_table_insert = ("""INSERT INTO artists ( \
+                            artist_id,  \
+                            name,  \
+                            location,  \
+                            latitude,  \
+                            longitude) \
+                          VALUES (%s, %s, %s, %s, %s) \
+                          ON CONFLICT (artist_id) DO UPDATE \
+                          SET name = EXCLUDED.name
+                          ; \
+                       """)
+
+time_table_insert = ("""INSERT INTO time ( \
+                            start_time, \
+                            hour, \
+                            day, \
+                            week,  \
+                            month,  \
+                            year,  \
+                            weekday) \
+                        VALUES (%s, %s, %s, %s, %s, %s, %s); \
+                     """)
+
+#
+# BATCH INSERT RECORDS
+# same conflict handling as the row inserts above, used by etl.py for the log_data;
+# the single VALUES placeholder is expanded to a multi-row list by psycopg2.extras.execute_values
+#
+user_table_batch_insert = ("""INSERT INTO users ( \
+                                  user_id,  \
+                                  first_name,  \
+                                  last_name,  \
+                                  gender,  \
+                                  level) \
+                              VALUES %s \
+                              ON CONFLICT (user_id) DO UPDATE \
+                              SET level = EXCLUDED.level; \
                            """)
-except psycopg2.Error as e: 
-    print("Error: Inserting artist rows")
-    print (e)
-
-try:
-    time_table_insert = ("""INSERT INTO time ( \
-                                start_time, \
-                                hour, \
-                                day, \
-                                week,  \
-                                month,  \
-                                year,  \
-                                weekday) \
-                            VALUES (%s, %s, %s, %s, %s, %s, %s); \
-                         """)
-except psycopg2.Error as e: 
-    print("Error: Inserting time rows")
-    print (e)
+
+time_table_batch_insert = ("""INSERT INTO time ( \
+                                  start_time, \
+                                  hour, \
+                                  day, \
+                                  week,  \
+                                  month,  \
+                                  year,  \
+                                  weekday) \
+                              VALUES %s; \
+                           """)
+
+#
+# PREPARED ROW INSERTS
+# used by the row-at-a-time fallback path, parsed and planned once per session;
+# the conflict handling is the same as of the row inserts above
+#
+song_table_prepare = ("""PREPARE song_insert (varchar, varchar, varchar, int, float) AS \
+                         INSERT INTO songs (song_id, title, artist_id, year, duration) \
+                         VALUES ($1, $2, $3, $4, $5) \
+                         ON CONFLICT (song_id) DO NOTHING; \
+                      """)
+
+artist_table_prepare = ("""PREPARE artist_insert (varchar, varchar, varchar, float, float) AS \
+                           INSERT INTO artists (artist_id, name, location, latitude, longitude) \
+                           VALUES ($1, $2, $3, $4, $5) \
+                           ON CONFLICT (artist_id) DO UPDATE \
+                           SET name = EXCLUDED.name; \
+                        """)
+
+song_table_execute = "EXECUTE song_insert (%s, %s, %s, %s, %s)"
+artist_table_execute = "EXECUTE artist_insert (%s, %s, %s, %s, %s)"
+
+song_table_deallocate = "DEALLOCATE song_insert"
+artist_table_deallocate = "DEALLOCATE artist_insert"
+
+#
+# COPY AND MERGE STAGING RECORDS
+# all chunks are copied into the staging tables first and merged once at the end of the load,
+# so the primary key indexes of the final tables are maintained by a single statement;
+# the merge keeps the conflict handling of the row inserts above,
+# DISTINCT ON avoids touching the same key twice within one statement
+#
+# NULL is marked explicitly with \N, so that empty strings are kept as ''
+song_staging_copy = "COPY songs_staging (song_id, title, artist_id, year, duration) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+artist_staging_copy = "COPY artists_staging (artist_id, name, location, latitude, longitude) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+song_staging_merge = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) \
+                         SELECT DISTINCT ON (song_id) song_id, title, artist_id, year, duration \
+                         FROM songs_staging \
+                         ON CONFLICT (song_id) DO NOTHING; \
+                      """)
+
+artist_staging_merge = ("""INSERT INTO artists (artist_id, name, location, latitude, longitude) \
+                           SELECT DISTINCT ON (artist_id) artist_id, name, location, latitude, longitude \
+                           FROM artists_staging \
+                           ON CONFLICT (artist_id) DO UPDATE \
+                           SET name = EXCLUDED.name; \
+                        """)
+
+song_staging_truncate = "TRUNCATE songs_staging"
+artist_staging_truncate = "TRUNCATE artists_staging"
+
+#
+# COPY SONGPLAYS RECORDS
+# the SERIAL ids are fetched as one block from the sequence,
+# so the fully-formed rows can be loaded with COPY
+#
+songplay_id_select = "SELECT nextval('songplays_songplay_id_seq') FROM generate_series(1, %s)"
+songplay_copy = ("COPY songplays (songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) "
+                 "FROM STDIN WITH (FORMAT csv, NULL '\\N')")
 
 # 
 # FIND SONGS
 #
-try:
-    song_select = ("""SELECT songs.song_id, songs.artist_id \
-                      FROM songs \
-                      JOIN artists ON songs.artist_id = artists.artist_id \
-                      WHERE songs.title = %s AND artists.name = %s AND songs.duration = %s; \
-                   """)
-except psycopg2.Error as e: 
-    print("Error: Selecting a song")
-    print (e)
+song_select = ("""SELECT songs.song_id, songs.artist_id \
+                  FROM songs \
+                  JOIN artists ON songs.artist_id = artists.artist_id \
+                  WHERE songs.title = %s AND artists.name = %s AND songs.duration = %s; \
+               """)
+
+# loaded once before the log_data processing to resolve song and artist ids in memory
+song_lookup_select = ("""SELECT songs.title, artists.name, songs.duration, songs.song_id, songs.artist_id \
+                         FROM songs \
+                         JOIN artists ON songs.artist_id = artists.artist_id; \
+                      """)
 
 #
 # QUERY LISTS
 #
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create,
+                        song_staging_table_create, artist_staging_table_create]
+session_setting_queries = [synchronous_commit_off, work_mem_set, maintenance_work_mem_set, check_function_bodies_off]
+prepare_queries = [song_table_prepare, artist_table_prepare]
+deallocate_queries = [song_table_deallocate, artist_table_deallocate]
+staging_merge_queries = [song_staging_merge, artist_staging_merge]
+staging_truncate_queries = [song_staging_truncate, artist_staging_truncate]
+drop_table_queries = [song_staging_table_drop, artist_staging_table_drop,
+                      songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]